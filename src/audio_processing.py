@@ -1,11 +1,22 @@
 #!/usr/bin/env python3
 import os
 import random
+import wave
 import numpy as np
 from pydub import AudioSegment
-import librosa
 import soundfile as sf
 import subprocess
+from functools import lru_cache
+
+try:
+    from randomgen import Xoshiro256
+except ImportError:
+    Xoshiro256 = None
+
+# Signals longer than this use a vectorization-friendly bit generator for noise
+LARGE_NOISE_BATCH = 16384
+# Samples of noise generated per step in add_noise (fits in L1 as float32)
+NOISE_CHUNK_SIZE = 8192
 
 
 def extract_random_segment(input_file, output_file, duration=10.0):
@@ -17,31 +28,51 @@ def extract_random_segment(input_file, output_file, duration=10.0):
         output_file (str): Path to output segment file
         duration (float): Duration of segment in seconds
     """
+    # Ensure the directory exists
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+
     try:
-        # Load the audio file
-        audio = AudioSegment.from_file(input_file)
+        # Seek straight to the segment instead of decoding the whole file
+        with sf.SoundFile(input_file) as f:
+            total_frames = f.frames
+            segment_frames = int(duration * f.samplerate)
+
+            if total_frames <= segment_frames:
+                print(f"Warning: Audio is shorter than {duration}s. Using whole file.")
+                start_frame = 0
+            else:
+                start_frame = random.randint(0, total_frames - segment_frames)
+
+            f.seek(start_frame)
+            data = f.read(segment_frames, dtype="float32")
+            samplerate = f.samplerate
 
-        # Calculate total duration in milliseconds
-        total_duration_ms = len(audio)
-        segment_duration_ms = int(duration * 1000)
+        sf.write(output_file, data, samplerate, subtype="PCM_16")
+
+        return output_file
+
+    except RuntimeError:
+        # Format not supported by libsndfile (e.g. m4a), decode with pydub instead
+        pass
+
+    try:
+        # Decoded PCM is memoized, so repeated segments of one file decode it once
+        samples, frame_rate = _load_pcm(input_file, os.path.getmtime(input_file))
+        segment_frames = int(duration * frame_rate)
 
         # Make sure we can extract a full segment
-        if total_duration_ms <= segment_duration_ms:
+        if len(samples) <= segment_frames:
             print(f"Warning: Audio is shorter than {duration}s. Using whole file.")
-            segment = audio
+            segment = samples
         else:
             # Choose a random start position
-            max_start_pos = total_duration_ms - segment_duration_ms
-            start_pos = random.randint(0, max_start_pos)
+            start_frame = random.randint(0, len(samples) - segment_frames)
 
             # Extract the segment
-            segment = audio[start_pos : start_pos + segment_duration_ms]
-
-        # Ensure the directory exists
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            segment = samples[start_frame : start_frame + segment_frames]
 
         # Export the segment
-        segment.export(output_file, format="wav")
+        sf.write(output_file, segment, frame_rate, subtype="PCM_16")
 
         return output_file
 
@@ -50,6 +81,23 @@ def extract_random_segment(input_file, output_file, duration=10.0):
         return None
 
 
+@lru_cache(maxsize=8)
+def _load_pcm(path, mtime):
+    """
+    Decode a file with pydub into 16-bit PCM, cached per path and modification time
+
+    Args:
+        path (str): Path to the audio file
+        mtime (float): Modification time, so edited files are decoded again
+
+    Returns:
+        tuple: (int16 samples with shape (n_frames, channels), frame rate)
+    """
+    audio = AudioSegment.from_file(path).set_sample_width(2)
+    samples = np.frombuffer(audio.raw_data, dtype=np.int16)
+    return samples.reshape(-1, audio.channels), audio.frame_rate
+
+
 def add_noise(
     input_file,
     output_file,
@@ -75,49 +123,39 @@ def add_noise(
     """
     if use_sox:
         try:
-            # Get duration of input audio
-            result = subprocess.run(
-                ["soxi", "-D", input_file], capture_output=True, text=True
+            # Read duration and rate from the header instead of spawning soxi
+            info = sf.info(input_file)
+            duration = info.duration
+            sample_rate = info.samplerate
+
+            effects_chain = build_sox_effects_chain(
+                duration=duration,
+                noise_type=noise_type,
+                noise_level=noise_level,
+                add_reverb=add_reverb,
+                apply_eq=apply_eq,
+                speed=speed,
+                pitch=pitch,
+                sample_rate=sample_rate,
+                # The effects run on the input itself when no noise is synthesized
+                input_rate=sample_rate if noise_level == 0 else None,
             )
-            duration = float(result.stdout.strip())
-
-            sample_rate = get_sample_rate(input_file)
 
             # If noise_level is 0, skip noise synthesis and apply effects directly
-
             if noise_level == 0:
-                effects_chain = build_sox_effects_chain(
-                    duration=duration,
-                    noise_type=noise_type,
-                    noise_level=0,
-                    add_reverb=add_reverb,
-                    apply_eq=apply_eq,
-                    speed=speed,
-                    pitch=pitch,
-                    sample_rate=sample_rate,
-                )
-
-                sox_command = f'sox "{input_file}" "{output_file}" {effects_chain}'
-                print("SOX CMD:", sox_command)
-
+                sox_command = ["sox", input_file, output_file] + effects_chain.split()
             else:
-                effects_chain = build_sox_effects_chain(
-                    duration=duration,
-                    noise_type=noise_type,
-                    noise_level=noise_level,
-                    add_reverb=add_reverb,
-                    apply_eq=apply_eq,
-                    speed=speed,
-                    pitch=pitch,
-                    sample_rate=sample_rate,
-                )
-                sox_command = (
-                    f'sox "{input_file}" -p | '
-                    f'sox -m -p "|sox -n -p {effects_chain}" '
-                    f'"{output_file}"'
-                )
-
-            subprocess.run(sox_command, shell=True, check=True)
+                # sox mixes the input file with the noise generator itself,
+                # so no shell and no extra decode stage are needed
+                sox_command = [
+                    "sox",
+                    "-m",
+                    input_file,
+                    f"|sox -n -p {effects_chain}",
+                    output_file,
+                ]
+
+            subprocess.run(sox_command, check=True)
             return output_file
 
         except Exception as e:
@@ -126,9 +164,21 @@ def add_noise(
 
     else:
         try:
-            y, sr = librosa.load(input_file, sr=None)
-            noise = np.random.normal(0, y.std() * noise_level, y.shape)
-            y_noisy = np.clip(y + noise, -1.0, 1.0)
+            y, sr = load_audio(input_file)
+            rng = noise_generator(len(y))
+            scale = np.float32(y.std() * noise_level)
+            y_noisy = np.empty_like(y, dtype=np.float32)
+            # Stream the noise through a small cache-resident buffer, fusing
+            # scale + add + clip per chunk instead of over whole-signal temporaries
+            noise = np.empty(NOISE_CHUNK_SIZE, dtype=np.float32)
+            for start in range(0, len(y), NOISE_CHUNK_SIZE):
+                stop = min(start + NOISE_CHUNK_SIZE, len(y))
+                chunk = noise[: stop - start]
+                rng.standard_normal(out=chunk, dtype=np.float32)
+                chunk *= scale
+                out = y_noisy[start:stop]
+                np.add(y[start:stop], chunk, out=out)
+                np.clip(out, -1.0, 1.0, out=out)
             sf.write(output_file, y_noisy, sr)
             return output_file
         except Exception as e:
@@ -136,11 +186,104 @@ def add_noise(
             return None
 
 
+def add_noise_levels(input_file, output_files, noise_levels):
+    """
+    Write several white-noise versions of one file with librosa+numpy
+
+    The input is decoded once and a single noise draw is scaled to every
+    level, instead of one add_noise call (decode + draw) per level.
+
+    Args:
+        input_file (str): Path to input audio file
+        output_files (list): Output path for each noise level
+        noise_levels (list): Noise levels (0.0-1.0)
+    Returns:
+        list or None: Paths to the outputs or None on failure
+    """
+    try:
+        y, sr = load_audio(input_file)
+        noise = noise_generator(len(y)).standard_normal(len(y), dtype=np.float32)
+        noise *= np.float32(y.std())
+        y_noisy = np.empty_like(y, dtype=np.float32)
+        for noise_level, output_file in zip(noise_levels, output_files):
+            np.multiply(noise, np.float32(noise_level), out=y_noisy)
+            y_noisy += y
+            np.clip(y_noisy, -1.0, 1.0, out=y_noisy)
+            sf.write(output_file, y_noisy, sr)
+        return list(output_files)
+    except Exception as e:
+        print(f"Error adding noise with librosa: {e}")
+        return None
+
+
+def load_audio(path, sr=None):
+    """
+    Read an audio file, collapse it to mono and optionally resample it
+
+    Decoded audio is memoized per path, modification time and size, so the
+    NF/WS sweeps and noise variants of one segment decode it only once. The
+    returned array is shared between callers and therefore read-only.
+
+    Args:
+        path (str): Path to the audio file
+        sr (int, optional): Target sample rate. If None, keeps the native rate
+
+    Returns:
+        tuple: (samples as float32 numpy array, sample rate)
+    """
+    stat = os.stat(path)
+    return _decode_audio(path, stat.st_mtime_ns, stat.st_size, sr)
+
+
+# Few entries: a segment needs at most two rates, and whole songs are large
+@lru_cache(maxsize=4)
+def _decode_audio(path, mtime_ns, size, sr):
+    """Decode, downmix and resample one file (see load_audio)"""
+    try:
+        y, native_sr = sf.read(path, dtype="float32", always_2d=False)
+    except RuntimeError:
+        # Format not supported by libsndfile (e.g. m4a), decode with pydub instead
+        samples, native_sr = _load_pcm(path, os.path.getmtime(path))
+        y = samples.astype(np.float32) / 32768.0
+    if y.ndim == 2:
+        y = y.mean(axis=1)
+    if sr is None or sr == native_sr:
+        y.flags.writeable = False
+        return y, native_sr
+
+    from math import gcd
+    from scipy.signal import resample_poly
+
+    factor = gcd(sr, native_sr)
+    y = resample_poly(y, sr // factor, native_sr // factor).astype(np.float32)
+    y.flags.writeable = False
+    return y, sr
+
+
+def noise_generator(num_samples):
+    """
+    Pick the random generator used to synthesize noise
+
+    Large batches use xoshiro256++ (randomgen) or SFC64, which vectorize better
+    than the default PCG64; short signals keep default_rng().
+
+    Args:
+        num_samples (int): Number of noise samples that will be drawn
+
+    Returns:
+        numpy.random.Generator: Generator to draw normals from
+    """
+    if num_samples <= LARGE_NOISE_BATCH:
+        return np.random.default_rng()
+    if Xoshiro256 is not None:
+        return np.random.Generator(Xoshiro256())
+    return np.random.Generator(np.random.SFC64())
+
+
 def get_sample_rate(path):
     try:
-        result = subprocess.run(["soxi", "-r", path], capture_output=True, text=True)
-        return int(result.stdout.strip())
-    except:
+        return sf.info(path).samplerate
+    except RuntimeError:
         return 44100  # fallback
 
 
@@ -153,9 +296,12 @@ def build_sox_effects_chain(
     speed=None,
     pitch=None,
     sample_rate=44100,
+    input_rate=None,
 ):
-    effects = [f"rate {sample_rate}"]
-    effects.append(f"rate {sample_rate}")
+    effects = []
+    # Only resample when the source rate differs (or is unknown, as for `sox -n`)
+    if input_rate != sample_rate:
+        effects.append(f"rate {sample_rate}")
     if noise_level > 0:
         effects.append(f"synth {duration} {noise_type} vol {noise_level}")
 
@@ -175,13 +321,34 @@ def build_sox_effects_chain(
     return " ".join(effects)
 
 
-def convert_to_mono_wav(input_file, output_file=None):
+def export_wav(segment, output_file):
+    """
+    Write a pydub AudioSegment as a WAV file straight from its raw PCM data
+
+    Args:
+        segment (AudioSegment): Audio to write
+        output_file (str): Path to output WAV file
+
+    Returns:
+        str: Path to the written file
+    """
+    with wave.open(output_file, "wb") as w:
+        w.setnchannels(segment.channels)
+        w.setsampwidth(segment.sample_width)
+        w.setframerate(segment.frame_rate)
+        w.writeframes(segment.raw_data)
+    return output_file
+
+
+def convert_to_mono_wav(input_file, output_file=None, use_ffmpeg=True):
     """
     Convert any audio file to mono WAV format at 44100Hz
 
     Args:
         input_file (str): Path to input audio file
         output_file (str, optional): Path to output WAV file. If None, uses input name with .wav extension
+        use_ffmpeg (bool): If True, let ffmpeg decode, downmix and resample in one pass
+            (falls back to pydub if ffmpeg fails)
 
     Returns:
         str: Path to the converted file
@@ -189,6 +356,35 @@ def convert_to_mono_wav(input_file, output_file=None):
     if output_file is None:
         output_file = os.path.splitext(input_file)[0] + ".wav"
 
+    if use_ffmpeg:
+        # ffmpeg cannot overwrite its own input, so go through a sibling temp file
+        temp_output = output_file + ".tmp.wav"
+        try:
+            subprocess.run(
+                [
+                    "ffmpeg",
+                    "-y",
+                    "-i",
+                    input_file,
+                    "-ac",
+                    "1",
+                    "-ar",
+                    "44100",
+                    "-f",
+                    "wav",
+                    temp_output,
+                ],
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            os.replace(temp_output, output_file)
+            return output_file
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"ffmpeg conversion failed ({e}), falling back to pydub")
+            if os.path.exists(temp_output):
+                os.remove(temp_output)
+
     try:
         # Load the audio file
         audio = AudioSegment.from_file(input_file)
@@ -199,8 +395,8 @@ def convert_to_mono_wav(input_file, output_file=None):
         # Convert to 44100Hz
         audio = audio.set_frame_rate(44100)
 
-        # Export as WAV
-        audio.export(output_file, format="wav")
+        # Write the PCM directly rather than through pydub's export chain
+        export_wav(audio, output_file)
 
         return output_file
 
@@ -1,11 +1,32 @@
 #!/usr/bin/env python3
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import matplotlib
+
+# Headless rendering: skip probing for an interactive GUI backend
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 from ncd import compare_compressors
 from music_identification import evaluate_compressor_performance
 
+_figure = None
+
+
+def get_axes(figsize):
+    """
+    Return a cleared axes on a figure shared by all plots in this module
+    """
+    global _figure
+    if _figure is None:
+        _figure = plt.figure(figsize=figsize)
+    else:
+        _figure.clf()
+        _figure.set_size_inches(*figsize)
+    return _figure, _figure.add_subplot()
+
+
 def plot_compression_sizes(files, compressors=None):
     """
     Plot the compression sizes for different files and compressors
@@ -15,15 +36,18 @@ def plot_compression_sizes(files, compressors=None):
     
     from ncd import compress_file
     
-    results = {}
-    for file in files:
-        results[os.path.basename(file)] = {}
-        for compressor in compressors:
-            size = compress_file(file, compressor)
-            results[os.path.basename(file)][compressor] = size
+    # The in-process compressors release the GIL while compressing, so threads are
+    # enough to overlap them
+    tasks = [(file, compressor) for file in files for compressor in compressors]
+    with ThreadPoolExecutor(max_workers=max(1, len(compressors))) as executor:
+        sizes = executor.map(lambda task: compress_file(*task), tasks)
+
+    results = {os.path.basename(file): {} for file in files}
+    for (file, compressor), size in zip(tasks, sizes):
+        results[os.path.basename(file)][compressor] = size
     
     # Plot results
-    fig, ax = plt.subplots(figsize=(10, 6))
+    fig, ax = get_axes((10, 6))
     
     width = 0.2
     x = np.arange(len(files))
@@ -39,9 +63,8 @@ def plot_compression_sizes(files, compressors=None):
     ax.set_xticklabels([os.path.basename(file) for file in files], rotation=45, ha='right')
     ax.legend()
     
-    plt.tight_layout()
-    plt.savefig('compression_sizes.png')
-    plt.close()
+    fig.tight_layout()
+    fig.savefig('compression_sizes.png')
 
 def plot_ncd_comparison(file_pairs, compressors=None):
     """
@@ -61,7 +84,7 @@ def plot_ncd_comparison(file_pairs, compressors=None):
         ncd_values[pair_name] = results
     
     # Plot results
-    fig, ax = plt.subplots(figsize=(12, 6))
+    fig, ax = get_axes((12, 6))
     
     width = 0.2
     x = np.arange(len(pair_labels))
@@ -77,9 +100,8 @@ def plot_ncd_comparison(file_pairs, compressors=None):
     ax.set_xticklabels(pair_labels, rotation=45, ha='right')
     ax.legend()
     
-    plt.tight_layout()
-    plt.savefig('ncd_comparison.png')
-    plt.close()
+    fig.tight_layout()
+    fig.savefig('ncd_comparison.png')
 
 def plot_compressor_accuracy(results):
     """
@@ -88,7 +110,7 @@ def plot_compressor_accuracy(results):
     compressors = list(results.keys())
     accuracy = [results[c]["accuracy"] for c in compressors]
     
-    fig, ax = plt.subplots(figsize=(10, 6))
+    fig, ax = get_axes((10, 6))
     
     ax.bar(compressors, accuracy)
     ax.set_xlabel('Compressor')
@@ -100,9 +122,8 @@ def plot_compressor_accuracy(results):
     for i, v in enumerate(accuracy):
         ax.text(i, v + 0.01, f"{v:.2%}", ha='center')
     
-    plt.tight_layout()
-    plt.savefig('compressor_accuracy.png')
-    plt.close()
+    fig.tight_layout()
+    fig.savefig('compressor_accuracy.png')
 
 def main():
     parser = argparse.ArgumentParser(description="Evaluate and compare different compressors")
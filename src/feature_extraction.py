@@ -3,13 +3,54 @@ import os
 import subprocess
 import tempfile
 import numpy as np
-import librosa
+import soundfile as sf
 import json
-from audio_processing import convert_to_mono_wav
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+import scipy.fft
+import scipy.signal
+from audio_processing import load_audio
+from ncd import FEATURE_FORMAT_VERSION
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft as pyfftw_fft
+
+    # Keep FFTW plans alive between calls so repeated frame sizes skip planning;
+    # the default 0.1 s keepalive lets them expire between two files
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(60)
+except ImportError:
+    pyfftw_fft = None
+
+try:
+    import cupy
+except ImportError:
+    cupy = None
 
 # Path to GetMaxFreqs executable - update this based on your system
 GETMAXFREQS_PATH = "./GetMaxFreqs/bin/GetMaxFreqs_exec"
 
+# Sample rate used by the internal extractor; the features need no more bandwidth
+ANALYSIS_SAMPLE_RATE = 22050
+
+# Audio file types picked up by process_directory
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".flac", ".ogg", ".m4a")
+
+# Layout of .freq files written by the internal extractor ("npz" or "json")
+FEATURE_FILE_FORMAT = "npz"
+
+# Threads per FFT; process pools drop this to 1 so workers do not oversubscribe
+FFT_WORKERS = os.cpu_count()
+
+# Run the STFT on the GPU with CuPy (see enable_gpu_fft)
+USE_GPU = False
+
 
 def check_getmaxfreqs():
     """Check if GetMaxFreqs executable exists and is callable"""
@@ -39,15 +80,24 @@ def convert_to_frequencies_external(
         )
     if output_file is None:
         output_file = os.path.splitext(audio_file)[0] + ".freq"
-    mono_wav = convert_to_mono_wav(audio_file)
+    # GetMaxFreqs reads 44.1 kHz stereo WAV: only re-encode what does not match
+    try:
+        info = sf.info(audio_file)
+        wav_44k = info.format == "WAV" and info.samplerate == 44100
+        channels = info.channels
+    except RuntimeError:
+        wav_44k = False
+        channels = None
     stereo_wav = tempfile.mktemp(suffix=".wav")
     try:
-        subprocess.run(
-            ["ffmpeg", "-i", mono_wav, "-ac", "2", stereo_wav],
-            check=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
+        if wav_44k and channels == 2:
+            getmaxfreqs_input = audio_file
+        else:
+            # Decode, downmix and resample in-process and write the stereo WAV
+            # directly, instead of two ffmpeg runs through a mono intermediate
+            y, _ = load_audio(audio_file, sr=44100)
+            sf.write(stereo_wav, np.column_stack((y, y)), 44100, subtype="PCM_16")
+            getmaxfreqs_input = stereo_wav
         # Passar NF e WS como argumentos para o GetMaxFreqs, se suportado
         subprocess.run(
             [
@@ -58,7 +108,7 @@ def convert_to_frequencies_external(
                 str(num_freqs),
                 "--ws",
                 str(frame_length),
-                stereo_wav,
+                getmaxfreqs_input,
             ],
             check=True,
         )
@@ -66,11 +116,212 @@ def convert_to_frequencies_external(
     except subprocess.CalledProcessError as e:
         print(f"Error calling GetMaxFreqs: {e}")
         return None
+    except Exception as e:
+        print(f"Error preparing audio for GetMaxFreqs: {e}")
+        return None
     finally:
         if os.path.exists(stereo_wav):
             os.remove(stereo_wav)
 
 
+@lru_cache(maxsize=None)
+def hann_window(frame_length):
+    """Periodic Hann window for a frame length, shared across calls and files"""
+    return scipy.signal.get_window("hann", frame_length).astype(np.float32)
+
+
+@lru_cache(maxsize=None)
+def mel_filter_bank(sr, frame_length, n_mels=128):
+    """Mel filter bank for a sample rate / FFT size, built once and reused across files"""
+    import librosa
+
+    return librosa.filters.mel(sr=sr, n_fft=frame_length, n_mels=n_mels).astype(
+        np.float32
+    )
+
+
+def magnitude_spectrogram(y, frame_length=1024, hop_length=256):
+    """
+    Magnitude STFT of a mono signal using scipy's real FFT
+
+    Frames are centred and zero padded the same way librosa.stft does by default.
+
+    Args:
+        y (numpy.ndarray): Mono audio samples
+        frame_length (int): FFT window size (WS)
+        hop_length (int): Number of samples between frames
+
+    Returns:
+        numpy.ndarray: Magnitudes with shape (frame_length // 2 + 1, n_frames)
+    """
+    y = np.pad(y.astype(np.float32, copy=False), frame_length // 2)
+    frames = np.lib.stride_tricks.sliding_window_view(y, frame_length)[::hop_length]
+    if USE_GPU:
+        # One transfer each way per signal; windowing and FFT run on the device
+        frames = cupy.asarray(np.ascontiguousarray(frames))
+        spectrum = cupy.fft.rfft(frames * cupy.asarray(hann_window(frame_length)))
+        return cupy.abs(spectrum).T.get()
+    # FFTW (when installed) is faster than pocketfft for large windows
+    fft = pyfftw_fft if pyfftw_fft is not None else scipy.fft
+    # The windowed frames are a temporary, so the FFT may work in their buffer
+    spectrum = fft.rfft(
+        frames * hann_window(frame_length),
+        axis=-1,
+        overwrite_x=True,
+        workers=FFT_WORKERS,
+    )
+    return np.abs(spectrum).T
+
+
+@lru_cache(maxsize=None)
+def _numba_top_k():
+    """Compile the top-k kernel on first use, or return None without numba"""
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return None
+
+    # cache=True keeps the compiled kernel on disk, so new processes skip compilation
+    @njit(parallel=True, fastmath=True, cache=True)
+    def top_k(frames, k, out_idx, out_mag):
+        # Keep a descending insertion-sorted buffer of the k largest bins per frame
+        for i in prange(frames.shape[0]):
+            for j in range(k):
+                out_idx[i, j] = 0
+                out_mag[i, j] = -1.0
+            for b in range(frames.shape[1]):
+                m = frames[i, b]
+                if m > out_mag[i, k - 1]:
+                    j = k - 1
+                    while j > 0 and out_mag[i, j - 1] < m:
+                        out_idx[i, j] = out_idx[i, j - 1]
+                        out_mag[i, j] = out_mag[i, j - 1]
+                        j -= 1
+                    out_idx[i, j] = b
+                    out_mag[i, j] = m
+
+    return top_k
+
+
+def top_k_bins(D, k):
+    """
+    Find the k strongest bins of every frame, strongest first
+
+    Args:
+        D (numpy.ndarray): Magnitude spectrogram with shape (n_bins, n_frames)
+        k (int): Number of bins to keep per frame
+
+    Returns:
+        tuple: (bin indices, magnitudes), both with shape (n_frames, k)
+    """
+    frames = np.ascontiguousarray(D.T)
+    # Small windows can have fewer bins than requested frequencies
+    k = min(k, frames.shape[1])
+    kernel = _numba_top_k()
+    if kernel is not None:
+        top_indices = np.empty((frames.shape[0], k), dtype=np.int32)
+        top_mags = np.empty((frames.shape[0], k), dtype=frames.dtype)
+        kernel(frames, k, top_indices, top_mags)
+        return top_indices, top_mags
+
+    top_indices = np.argpartition(frames, -k, axis=1)[:, -k:]
+    top_mags = np.take_along_axis(frames, top_indices, axis=1)
+    order = np.argsort(-top_mags, axis=1)
+    return (
+        np.take_along_axis(top_indices, order, axis=1),
+        np.take_along_axis(top_mags, order, axis=1),
+    )
+
+
+def write_feature_file(output_file, feature_data, file_format=None):
+    """
+    Serialize extracted features to the .freq file
+
+    "npz" stores the arrays as raw float32 in an uncompressed NumPy archive, so
+    the NCD compressors see the binary data rather than its decimal text. "json"
+    keeps the text layout, letting orjson encode numpy arrays directly.
+
+    Args:
+        output_file (str): Path to output frequency file
+        feature_data (dict): Features, possibly holding numpy arrays
+        file_format (str, optional): "npz" or "json" (default: FEATURE_FILE_FORMAT)
+    """
+    file_format = file_format or FEATURE_FILE_FORMAT
+    if file_format == "npz":
+        # Writing through a handle stops numpy from appending ".npz" to the name
+        with open(output_file, "wb") as f:
+            np.savez(f, **feature_data)
+        return
+
+    if orjson is not None:
+        with open(output_file, "wb") as f:
+            f.write(
+                orjson.dumps(
+                    feature_data,
+                    option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+                )
+            )
+        return
+
+    feature_data = {
+        key: value.tolist() if isinstance(value, (np.ndarray, np.generic)) else value
+        for key, value in feature_data.items()
+    }
+    with open(output_file, "w") as f:
+        json.dump(feature_data, f)
+
+
+def spectral_features(audio_file, frame_length=1024):
+    """
+    Magnitude STFT and NF-independent features of an audio file
+
+    Memoized per path, modification time, size and frame length, so the NF
+    sweep of a segment computes its spectrogram once and only re-selects the
+    top bins. The returned spectrogram is shared between callers and
+    therefore read-only.
+
+    Args:
+        audio_file (str): Path to input audio file
+        frame_length (int): FFT window size (WS)
+
+    Returns:
+        tuple: (magnitudes with shape (n_bins, n_frames), sample rate,
+            dictionary of summary features)
+    """
+    stat = os.stat(audio_file)
+    return _spectral_features(audio_file, stat.st_mtime_ns, stat.st_size, frame_length)
+
+
+# Few entries: sweeps convert one segment at a time, and large windows are large
+@lru_cache(maxsize=2)
+def _spectral_features(audio_file, mtime_ns, size, frame_length):
+    """Compute the spectrogram and summary features of one file (see spectral_features)"""
+    # librosa pulls in numba, so only import it when features are needed
+    import librosa
+
+    y, sr = load_audio(audio_file, sr=ANALYSIS_SAMPLE_RATE)
+    hop_length = 256
+    D = magnitude_spectrogram(y, frame_length=frame_length, hop_length=hop_length)
+    # Every feature reuses this one STFT instead of computing its own
+    D = D.astype(np.float32, copy=False)
+    S_power = D**2
+    mel = mel_filter_bank(sr, frame_length) @ S_power
+    mfccs = librosa.feature.mfcc(S=librosa.power_to_db(mel), n_mfcc=13)
+    centroid = librosa.feature.spectral_centroid(S=D, sr=sr, n_fft=frame_length)[0]
+    contrast = librosa.feature.spectral_contrast(S=D, sr=sr, n_fft=frame_length)
+    chroma = librosa.feature.chroma_stft(S=S_power, sr=sr, n_fft=frame_length)
+    features = {
+        "mfcc": np.mean(mfccs, axis=1),
+        "mfcc_std": np.std(mfccs, axis=1),
+        "centroid": float(np.mean(centroid)),
+        "contrast": np.mean(contrast, axis=1),
+        "chroma": np.mean(chroma, axis=1),
+        "duration": len(y) / sr,
+    }
+    D.flags.writeable = False
+    return D, sr, features
+
+
 def convert_to_frequencies_internal(
     audio_file, output_file=None, num_freqs=4, frame_length=1024
 ):
@@ -87,37 +338,21 @@ def convert_to_frequencies_internal(
     if output_file is None:
         output_file = os.path.splitext(audio_file)[0] + ".freq"
     try:
-        y, sr = librosa.load(audio_file, sr=None, mono=True)
-        hop_length = 256
-        D = np.abs(librosa.stft(y, n_fft=frame_length, hop_length=hop_length))
-        mfccs = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
-        mfcc_mean = np.mean(mfccs, axis=1).tolist()
-        mfcc_std = np.std(mfccs, axis=1).tolist()
-        centroid = librosa.feature.spectral_centroid(y=y, sr=sr)[0]
-        centroid_mean = float(np.mean(centroid))
-        contrast = librosa.feature.spectral_contrast(y=y, sr=sr)
-        contrast_mean = np.mean(contrast, axis=1).tolist()
-        chroma = librosa.feature.chroma_stft(y=y, sr=sr)
-        chroma_mean = np.mean(chroma, axis=1).tolist()
-        freq_data = []
-        freqs = librosa.fft_frequencies(sr=sr, n_fft=frame_length)
-        for frame in range(D.shape[1]):
-            magnitudes = D[:, frame]
-            top_indices = np.argsort(magnitudes)[-num_freqs:]
-            frame_freqs = [(freqs[idx], float(magnitudes[idx])) for idx in top_indices]
-            frame_freqs.sort(key=lambda x: x[1], reverse=True)
-            freq_data.append(frame_freqs)
+        D, sr, features = spectral_features(audio_file, frame_length=frame_length)
+        top_indices, top_mags = top_k_bins(D, num_freqs)
+        # Store bin numbers (bin k of an n-point FFT sits at k * sr / n Hz) in the
+        # narrowest integer type, and magnitudes at half precision: the per-frame
+        # tokens dominate the file, so this halves what the compressors must chew on
+        bin_dtype = np.uint8 if D.shape[0] <= 256 else np.uint16
         feature_data = {
-            "freq_frames": freq_data,
-            "mfcc": mfcc_mean,
-            "mfcc_std": mfcc_std,
-            "centroid": centroid_mean,
-            "contrast": contrast_mean,
-            "chroma": chroma_mean,
-            "duration": len(y) / sr,
+            # Lets load_database skip files written in an older layout
+            "format_version": np.uint8(FEATURE_FORMAT_VERSION),
+            "top_bins": top_indices.astype(bin_dtype),
+            "bin_hz": sr / frame_length,
+            "top_mags": top_mags.astype(np.float16),
+            **features,
         }
-        with open(output_file, "w") as f:
-            json.dump(feature_data, f)
+        write_feature_file(output_file, feature_data)
         return output_file
     except Exception as e:
         print(f"Error extracting frequencies: {e}")
@@ -149,36 +384,85 @@ def convert_to_frequencies(
     return result
 
 
-def process_directory(directory):
+def enable_gpu_fft():
+    """
+    Compute spectrograms on the GPU from now on, if CuPy is installed
+
+    Call it before creating process pools, so forked workers inherit it.
+
+    Returns:
+        bool: True if the GPU will be used
+    """
+    global USE_GPU
+    USE_GPU = cupy is not None
+    return USE_GPU
+
+
+def limit_worker_threads():
+    """Single-threaded FFT and native libraries, for processes inside a pool"""
+    global FFT_WORKERS
+    FFT_WORKERS = 1
+    os.environ["OMP_NUM_THREADS"] = "1"
+
+
+def init_worker():
+    """Limit native threads and warm up imports once per worker process"""
+    limit_worker_threads()
+    import librosa  # noqa: F401
+
+    # Compile (or load) the top-k kernel before the first file arrives
+    top_k_bins(np.zeros((8, 2), dtype=np.float32), 1)
+
+
+def process_file(filepath, output_file):
+    """Convert a single audio file (runs inside a worker process)"""
+    return convert_to_frequencies(filepath, output_file)
+
+
+def process_directory(directory, max_workers=None):
     """
     Process all audio files in a directory and save frequency representations to database
 
     Args:
         directory (str): Directory containing audio files
+        max_workers (int, optional): Number of worker processes (default: CPU count)
     """
     os.makedirs(directory, exist_ok=True)
 
-    wav_count = 0
-
-    for filename in os.listdir(directory):
-        filepath = os.path.join(directory, filename)
+    jobs = []
 
-        # Skip directories and non-audio files
-        if os.path.isdir(filepath) or not filename.lower().endswith(
-            (".mp3", ".wav", ".flac", ".ogg", ".m4a")
-        ):
-            continue
+    # scandir entries carry their file type, so no extra stat per file
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # Skip directories and non-audio files
+            if not entry.is_file() or not entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                continue
 
-        wav_count += 1
-        print(f"Processing {filename}...")
+            # Generate output path in database directory
+            output_file = os.path.join(
+                directory, os.path.splitext(entry.name)[0] + ".freq"
+            )
+            jobs.append((entry.path, output_file))
 
-        # Generate output path in database directory
-        output_file = os.path.join(directory, os.path.splitext(filename)[0] + ".freq")
+    wav_count = len(jobs)
+    freq_count = 0
 
-        # Convert to frequency representation
-        convert_to_frequencies(filepath, output_file)
-
-    # Count number of .freq files in output directory
-    freq_count = sum(1 for f in os.listdir(directory) if f.lower().endswith(".freq"))
+    # Each file is an independent conversion, so spread them over processes
+    # (never more workers than files, so small directories do not over-spawn)
+    max_workers = min(max_workers or os.cpu_count(), max(wav_count, 1))
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=init_worker
+    ) as executor:
+        futures = {
+            executor.submit(process_file, filepath, output_file): filepath
+            for filepath, output_file in jobs
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            filename = os.path.basename(futures[future])
+            if future.result() is None:
+                print(f"[{done}/{wav_count}] Failed to process {filename}")
+            else:
+                freq_count += 1
+                print(f"[{done}/{wav_count}] Processed {filename}")
 
     print(f"✅ Successfully processed {freq_count}/{wav_count} files")
@@ -5,67 +5,90 @@ import sounddevice as sd
 import soundfile as sf
 import librosa
 import tempfile
-from ncd import calculate_ncd_with_database
+import threading
+import queue
+from ncd import DEFAULT_COMPRESSOR, calculate_ncd_with_database, load_database
 from music_identification import identify_music
-from audio_processing import convert_to_mono_wav
 from feature_extraction import convert_to_frequencies
 
 
-def record_audio(duration=10, sample_rate=44100):
+def record_to_wav(duration=10, sample_rate=44100):
     """
-    Record audio from the microphone
+    Record audio from the microphone straight into a temporary WAV file
+
+    A background thread writes each block as it arrives and signals once
+    the requested number of frames has been written, so the file is
+    complete as soon as the recording ends.
 
     Args:
         duration (float): Recording duration in seconds
         sample_rate (int): Sample rate for recording
 
-    Returns:
-        tuple: (audio_data, sample_rate)
-    """
-    print(f"Recording for {duration} seconds...")
-    recording = sd.rec(int(duration * sample_rate), samplerate=sample_rate, channels=1)
-    sd.wait()
-    print("Recording finished!")
-    return recording, sample_rate
-
-
-def save_temp_audio(audio_data, sample_rate):
-    """
-    Save audio data to a temporary WAV file
-
-    Args:
-        audio_data (numpy.ndarray): Audio data
-        sample_rate (int): Sample rate
-
     Returns:
         str: Path to temporary file
     """
     temp_file = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-    sf.write(temp_file.name, audio_data, sample_rate)
+    blocks = queue.Queue()
+    done = threading.Event()
+
+    def callback(indata, frames, time, status):
+        blocks.put(indata.copy())
+
+    def writer():
+        remaining = int(duration * sample_rate)
+        with sf.SoundFile(
+            temp_file.name, "w", samplerate=sample_rate, channels=1, subtype="PCM_16"
+        ) as f:
+            while (block := blocks.get()) is not None:
+                if remaining > 0:
+                    f.write(block[:remaining])
+                    remaining -= len(block)
+                    if remaining <= 0:
+                        done.set()
+
+    writer_thread = threading.Thread(target=writer)
+    writer_thread.start()
+
+    print(f"Recording for {duration} seconds...")
+    try:
+        with sd.InputStream(
+            samplerate=sample_rate,
+            channels=1,
+            dtype="float32",
+            blocksize=1024,
+            callback=callback,
+        ):
+            done.wait()
+    finally:
+        blocks.put(None)
+        writer_thread.join()
+    print("Recording finished!")
     return temp_file.name
 
 
 def main():
-    # Record audio
-    audio_data, sample_rate = record_audio(duration=10)
+    # Load the database while recording, instead of after it
+    warmup = threading.Thread(target=load_database, daemon=True)
+    warmup.start()
 
-    # Save to temporary file
-    temp_wav = save_temp_audio(audio_data, sample_rate)
+    # Record audio (already mono 44.1 kHz, so no conversion is needed)
+    temp_wav = record_to_wav(duration=10)
+    freq_file = None
+    warmup.join()
 
     try:
-        # Convert to mono WAV if needed
-        mono_wav = convert_to_mono_wav(temp_wav)
-
         # Convert to frequency representation
         temp_freq = tempfile.NamedTemporaryFile(suffix=".freq", delete=False)
-        freq_file = convert_to_frequencies(mono_wav, temp_freq.name)
+        freq_file = convert_to_frequencies(temp_wav, temp_freq.name)
 
         if freq_file is None:
             print("Error: Failed to convert audio to frequency representation")
             return
 
         # Calculate NCD with database
-        ncd_results = calculate_ncd_with_database(freq_file, compressor="bzip2")
+        ncd_results = calculate_ncd_with_database(
+            freq_file, compressor=DEFAULT_COMPRESSOR
+        )
 
         # Identify the music
         matches = identify_music(ncd_results, num_results=3)
@@ -77,8 +100,6 @@ def main():
     finally:
         # Clean up temporary files
         os.unlink(temp_wav)
-        if mono_wav and mono_wav != temp_wav:
-            os.unlink(mono_wav)
         if freq_file:
             os.unlink(freq_file)
 
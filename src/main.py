@@ -3,9 +3,20 @@ import argparse
 import os
 from audio_processing import extract_random_segment, add_noise
 from feature_extraction import convert_to_frequencies
-from ncd import calculate_ncd_with_database
+from ncd import calculate_ncd_with_database, pack_database
 from music_identification import identify_music
 
+COMPRESSOR_CHOICES = [
+    "gzip",
+    "bzip2",
+    "lzma",
+    "zstd",
+    "zstd_fast",
+    "zstd_dict",
+    "lz4",
+    "zstd_prefix",
+]
+
 
 def ensure_directories():
     """Ensure required directories exist"""
@@ -55,9 +66,19 @@ def main():
     compare_parser.add_argument(
         "-c",
         "--compressor",
-        default="gzip",
-        choices=["gzip", "bzip2", "lzma", "zstd"],
-        help="Compressor to use",
+        default="zstd_fast",
+        choices=COMPRESSOR_CHOICES,
+        help="Compressor used to scan the database (default: zstd_fast; lz4 is faster still)",
+    )
+    compare_parser.add_argument(
+        "--rescore-compressor",
+        choices=COMPRESSOR_CHOICES,
+        help="Re-score the best candidates with this compressor (e.g. lzma)",
+    )
+    compare_parser.add_argument(
+        "--rescore-top",
+        type=int,
+        help="Number of candidates to re-score (default: twice --num-results)",
     )
     compare_parser.add_argument(
         "-n",
@@ -134,7 +155,13 @@ def main():
         else:
             segment_file = args.segment_file
 
-        results = calculate_ncd_with_database(segment_file, args.compressor)
+        results = calculate_ncd_with_database(
+            segment_file,
+            args.compressor,
+            rescore_compressor=args.rescore_compressor,
+            rescore_top=args.rescore_top or max(2 * args.num_results, 1),
+            prune_top=args.num_results,
+        )
         top_candidates = identify_music(results, args.num_results)
 
         print(f"\nTop {args.num_results} candidates:")
@@ -166,6 +193,7 @@ def main():
         from feature_extraction import process_directory
 
         process_directory(args.directory)
+        pack_database(args.directory)
 
     else:
         parser.print_help()
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 import os
 import json
+import heapq
+from operator import itemgetter
 from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor
 
 def identify_music(ncd_results, num_results=5):
     """
@@ -14,25 +17,50 @@ def identify_music(ncd_results, num_results=5):
     Returns:
         list: List of tuples (name, distance) sorted by distance
     """
-    # Sort results by NCD value (lower is better)
-    sorted_results = sorted(ncd_results.items(), key=lambda x: x[1])
+    # Partial selection of the lowest NCD values (lower is better); same order as sorting
+    return heapq.nsmallest(num_results, ncd_results.items(), key=itemgetter(1))
+
+def _eval_one_segment(segment_file, directory, compressors):
+    """
+    Check which compressors identify one segment correctly (runs inside a worker process).
+    
+    Returns:
+        dict: Maps each compressor to whether its top match is the ground truth
+    """
+    from ncd import calculate_ncd_with_database
     
-    # Return top results
-    return sorted_results[:num_results]
+    # Extract ground truth from filename (assumed format: original_name_segment.freq)
+    original_name = segment_file.split("_")[0]
+    segment_path = os.path.join(directory, segment_file)
+    
+    print(f"Testing {segment_file} (ground truth: {original_name})")
+    
+    correct = {}
+    for compressor in compressors:
+        # Segments are already spread over processes, so scan the database inline;
+        # only the top match is needed, so files that cannot beat it are pruned
+        ncd_results = calculate_ncd_with_database(
+            segment_path, compressor, max_workers=1, prune_top=1, verbose=False
+        )
+        
+        # Get top match
+        top_matches = identify_music(ncd_results, 1)
+        correct[compressor] = bool(top_matches) and top_matches[0][0] == original_name
+    
+    return correct
 
-def evaluate_compressor_performance(directory, compressors=None):
+def evaluate_compressor_performance(directory, compressors=None, max_workers=None):
     """
     Evaluate the performance of different compressors on a test set.
     
     Args:
         directory (str): Directory containing test segments with known sources
         compressors (list): List of compressors to test
+        max_workers (int, optional): Number of worker processes (default: CPU count)
         
     Returns:
         dict: Dictionary with accuracy metrics for each compressor
     """
-    from ncd import calculate_ncd_with_database
-    
     if compressors is None:
         compressors = ["gzip", "bzip2", "xz", "zstd"]
     
@@ -41,23 +69,17 @@ def evaluate_compressor_performance(directory, compressors=None):
     # Get all segments in the directory
     segment_files = [f for f in os.listdir(directory) if f.endswith(".freq")]
     
-    for segment_file in segment_files:
-        # Extract ground truth from filename (assumed format: original_name_segment.freq)
-        original_name = segment_file.split("_")[0]
-        segment_path = os.path.join(directory, segment_file)
-        
-        print(f"Testing {segment_file} (ground truth: {original_name})")
-        
-        # Test with each compressor
-        for compressor in compressors:
-            ncd_results = calculate_ncd_with_database(segment_path, compressor)
-            
-            # Get top match
-            top_matches = identify_music(ncd_results, 1)
-            if top_matches and top_matches[0][0] == original_name:
-                results[compressor]["correct"] += 1
-                
-            results[compressor]["total"] += 1
+    # Segments are independent, so evaluate them in parallel and fold the counts
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for correct in executor.map(
+            _eval_one_segment,
+            segment_files,
+            [directory] * len(segment_files),
+            [compressors] * len(segment_files)
+        ):
+            for compressor, is_correct in correct.items():
+                results[compressor]["correct"] += int(is_correct)
+                results[compressor]["total"] += 1
     
     # Calculate accuracy for each compressor
     for compressor in compressors:
@@ -2,7 +2,284 @@
 import os
 import subprocess
 import glob
+import heapq
+import io
+import json
+import zlib
+import bz2
+import lzma
+import mmap
+import pickle
+import re
+import threading
+import zipfile
 from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Trained dictionary used by the "zstd_dict" compressor, stored in the database directory
+ZSTD_DICT_FILE = ".zstd_dict"
+
+# Persistent cache of database compressed sizes, stored in the database directory
+SIZE_CACHE_FILE = ".csize_cache.pkl"
+
+# Packed database: every .freq file back to back, plus a JSON index of where each one is
+DB_SHARD_FILE = ".db.bin"
+DB_INDEX_FILE = ".db.idx"
+
+# Layout version recorded in the .freq files written by feature_extraction; database
+# files from another version are skipped until they are regenerated
+FEATURE_FORMAT_VERSION = 2
+_JSON_FORMAT_VERSION = re.compile(rb'"format_version":\s*(\d+)')
+
+# Per-process copies of each database directory, shared by every query
+_databases = {}
+_size_caches = {}
+_database_lock = threading.Lock()
+
+# zstd compression contexts, kept per thread because they cannot be shared concurrently
+_zstd_local = threading.local()
+
+def _zstd_compressor(level=3, dict_data=None):
+    """ZstdCompressor reused by the calling thread instead of being rebuilt per call"""
+    compressors = getattr(_zstd_local, "compressors", None)
+    if compressors is None:
+        compressors = _zstd_local.compressors = {}
+    key = (level, id(dict_data))
+    entry = compressors.get(key)
+    # Rebuilt when the dictionary has been retrained
+    if entry is None or entry[0] is not dict_data:
+        # One per database prefix at most, so drop the oldest like _zstd_prefixes does
+        if len(compressors) >= ZSTD_PREFIX_CACHE_SIZE:
+            compressors.pop(next(iter(compressors)))
+        entry = (dict_data, zstandard.ZstdCompressor(level=level, dict_data=dict_data))
+        compressors[key] = entry
+    return entry[1]
+
+def _zstd_compress(data, level=3):
+    """Compress with the zstandard bindings, or the zstd CLI if they are missing"""
+    if zstandard is None:
+        return subprocess.run(
+            ["zstd", f"-{level}", "-c"],
+            input=data,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True
+        ).stdout
+    return _zstd_compressor(level).compress(data)
+
+def build_zstd_dict(database_dir="database", dict_size=131072):
+    """
+    Train a zstd dictionary on the database .freq files and save it next to them.
+    
+    Args:
+        database_dir (str): Directory containing the database frequency files
+        dict_size (int): Maximum dictionary size in bytes
+        
+    Returns:
+        zstandard.ZstdCompressionDict: The trained dictionary
+    """
+    if zstandard is None:
+        raise ValueError("The zstd_dict compressor requires the zstandard package")
+    
+    database_files = glob.glob(os.path.join(database_dir, "*.freq"))
+    samples = [read_file(db_file) for db_file in database_files]
+    zstd_dict = zstandard.train_dictionary(dict_size, samples)
+    
+    with open(os.path.join(database_dir, ZSTD_DICT_FILE), 'wb') as f:
+        f.write(zstd_dict.as_bytes())
+    
+    # Sizes cached with the previous dictionary are no longer valid
+    cache = load_size_cache(database_dir)
+    save_size_cache(
+        {key: size for key, size in cache.items() if key[3] != "zstd_dict"},
+        database_dir
+    )
+    load_zstd_dict.cache_clear()
+    
+    return zstd_dict
+
+@lru_cache(maxsize=None)
+def load_zstd_dict(database_dir="database"):
+    """
+    Load the trained zstd dictionary for a database, training it on first use.
+    
+    Args:
+        database_dir (str): Directory containing the database frequency files
+        
+    Returns:
+        zstandard.ZstdCompressionDict: The dictionary, or None if it could not
+        be trained, in which case zstd_dict compresses like plain zstd
+    """
+    try:
+        return zstandard.ZstdCompressionDict(
+            read_file(os.path.join(database_dir, ZSTD_DICT_FILE))
+        )
+    except FileNotFoundError:
+        pass
+    try:
+        return build_zstd_dict(database_dir)
+    except zstandard.ZstdError as e:
+        # Too few or too small samples to train on
+        print(f"Warning: could not train the zstd dictionary ({e}), using plain zstd")
+        return None
+
+def _zstd_dict_compress(data):
+    """Compress with zstd primed with the dictionary trained on the database"""
+    if zstandard is None:
+        raise ValueError("The zstd_dict compressor requires the zstandard package")
+    return _zstd_compressor(3, load_zstd_dict()).compress(data)
+
+# Database files loaded as raw-content zstd prefixes, keyed like the size cache
+_zstd_prefixes = {}
+ZSTD_PREFIX_CACHE_SIZE = 256
+
+def _zstd_prefix(data, key=None):
+    """
+    Raw-content zstd dictionary holding data, so other buffers can be compressed
+    as if they followed it. Kept per process when a key is given.
+    """
+    if zstandard is None:
+        raise ValueError("The zstd_prefix compressor requires the zstandard package")
+    prefix = _zstd_prefixes.get(key) if key is not None else None
+    if prefix is None:
+        prefix = zstandard.ZstdCompressionDict(
+            bytes(data), dict_type=zstandard.DICT_TYPE_RAWCONTENT
+        )
+        # Index the content once; every compressor built on it then starts warm
+        prefix.precompute_compress(level=3)
+        if key is not None:
+            with _database_lock:
+                if len(_zstd_prefixes) >= ZSTD_PREFIX_CACHE_SIZE:
+                    _zstd_prefixes.pop(next(iter(_zstd_prefixes)))
+                _zstd_prefixes[key] = prefix
+    return prefix
+
+def _lz4_compress(data):
+    """Compress with LZ4: much faster than the others but a weaker model, for first passes"""
+    if lz4 is None:
+        raise ValueError("The lz4 compressor requires the lz4 package")
+    return lz4.frame.compress(data)
+
+# In-process equivalents of the gzip/bzip2/lzma/zstd command line defaults
+COMPRESSORS = {
+    "gzip": lambda data: zlib.compress(data, 6),
+    "bzip2": lambda data: bz2.compress(data, 9),
+    "lzma": lambda data: lzma.compress(data, format=lzma.FORMAT_ALONE),
+    "zstd": _zstd_compress,
+    # zstd -1: fastest setting, meant for first-pass database scans
+    "zstd_fast": lambda data: _zstd_compress(data, level=1),
+    "zstd_dict": _zstd_dict_compress,
+    "lz4": _lz4_compress,
+    # Plain zstd sizes; x||y is sized as c_y plus x compressed against y (see ncd_bytes)
+    "zstd_prefix": _zstd_compress
+}
+
+# Compressors whose C(xy) may be below max(C(x), C(y)), so the size lower bound
+# used to prune database scans does not hold for them: they always score every file
+UNPRUNABLE_COMPRESSORS = {"zstd_prefix"}
+
+# Used by the live and web front ends: zstd with the trained dictionary when available
+DEFAULT_COMPRESSOR = "zstd_dict" if zstandard is not None else "bzip2"
+
+# Incremental compressors, used to compress x||y without building the concatenation.
+# Each factory takes the total input size (zstd records it in the frame header).
+STREAM_COMPRESSORS = {
+    "gzip": lambda size: zlib.compressobj(6),
+    "bzip2": lambda size: bz2.BZ2Compressor(9),
+    "lzma": lambda size: lzma.LZMACompressor(format=lzma.FORMAT_ALONE)
+}
+if zstandard is not None:
+    STREAM_COMPRESSORS["zstd"] = lambda size: _zstd_compressor(3).compressobj(size=size)
+    STREAM_COMPRESSORS["zstd_fast"] = lambda size: _zstd_compressor(1).compressobj(size=size)
+    STREAM_COMPRESSORS["zstd_dict"] = (
+        lambda size: _zstd_compressor(3, load_zstd_dict()).compressobj(size=size)
+    )
+
+def compress_parts(parts, compressor="gzip"):
+    """
+    Compressed size of the concatenation of several buffers.
+    
+    The buffers are fed one after another into a single compressor stream, so
+    x||y is never materialized in memory.
+    
+    Args:
+        parts (list): Buffers to compress (bytes, mmap or any bytes-like object)
+        compressor (str): Compressor to use (gzip, bzip2, lzma, zstd, zstd_fast, zstd_dict, lz4, zstd_prefix)
+        
+    Returns:
+        int: Size of the compressed data in bytes
+    """
+    if compressor not in COMPRESSORS:
+        raise ValueError(f"Unsupported compressor: {compressor}")
+    
+    try:
+        if len(parts) == 1:
+            return len(COMPRESSORS[compressor](parts[0]))
+        if compressor not in STREAM_COMPRESSORS:
+            return len(COMPRESSORS[compressor](b"".join(parts)))
+        
+        stream = STREAM_COMPRESSORS[compressor](sum(len(part) for part in parts))
+        size = sum(len(stream.compress(part)) for part in parts)
+        return size + len(stream.flush())
+    except (subprocess.CalledProcessError, lzma.LZMAError, zlib.error, OSError) as e:
+        print(f"Error compressing data: {e}")
+        return 0
+
+def compress_bytes(data, compressor="gzip"):
+    """
+    Compress a buffer in memory and return the size of the compressed data.
+    
+    Args:
+        data (bytes): Data to compress
+        compressor (str): Compressor to use (gzip, bzip2, lzma, zstd, zstd_fast, zstd_dict, lz4, zstd_prefix)
+        
+    Returns:
+        int: Size of the compressed data in bytes
+    """
+    return compress_parts([data], compressor)
+
+def read_file(filename):
+    """
+    Read a file's raw bytes.
+    
+    Args:
+        filename (str): Path to the file
+        
+    Returns:
+        bytes: File contents
+    """
+    with open(filename, 'rb') as f:
+        return f.read()
+
+@contextmanager
+def mapped_file(filename):
+    """
+    Memory-map a file read-only, so compressors read it without an extra copy.
+    
+    Args:
+        filename (str): Path to the file
+        
+    Yields:
+        mmap.mmap or bytes: The file contents (b"" for empty files, which cannot be mapped)
+    """
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
 
 def compress_file(filename, compressor="gzip"):
     """
@@ -10,134 +287,465 @@ def compress_file(filename, compressor="gzip"):
     
     Args:
         filename (str): Path to the file to compress
-        compressor (str): Compressor to use (gzip, bzip2, lzma, zstd, xz)
+        compressor (str): Compressor to use (gzip, bzip2, lzma, zstd, zstd_fast, zstd_dict, lz4, zstd_prefix)
         
     Returns:
         int: Size of the compressed file in bytes
     """
-    compressor_cmds = {
-        "gzip": ["gzip", "-c"],
-        "bzip2": ["bzip2", "-c"],
-        "lzma": ["lzma", "-c"],
-        #"xz": ["xz", "-c"],
-        "zstd": ["zstd", "-c"]
-    }
-    
-    if compressor not in compressor_cmds:
-        raise ValueError(f"Unsupported compressor: {compressor}")
-    
     try:
-        with open(os.devnull, 'wb') as devnull:
-            result = subprocess.run(
-                compressor_cmds[compressor] + [filename],
-                stdout=subprocess.PIPE,
-                stderr=devnull,
-                check=True
-            )
-        return len(result.stdout)
-    except subprocess.CalledProcessError as e:
+        with mapped_file(filename) as data:
+            return compress_bytes(data, compressor)
+    except OSError as e:
         print(f"Error compressing file: {e}")
         return 0
 
-def concatenate_files(file1, file2):
+def _size_cache_key(filename, compressor):
+    """Cache key that changes whenever the file is modified"""
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size, compressor)
+
+def load_size_cache(database_dir="database"):
     """
-    Concatenate two files and return the path to the concatenated file.
+    Load the persistent compressed-size cache of a database directory.
+    
+    The file is only read the first time; later calls in the same process
+    return the same dictionary.
     
     Args:
-        file1 (str): Path to the first file
-        file2 (str): Path to the second file
+        database_dir (str): Directory containing the database frequency files
+        
+    Returns:
+        dict: Maps (path, mtime_ns, size, compressor) to compressed sizes
+    """
+    with _database_lock:
+        if database_dir not in _size_caches:
+            try:
+                with open(os.path.join(database_dir, SIZE_CACHE_FILE), 'rb') as f:
+                    _size_caches[database_dir] = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                _size_caches[database_dir] = {}
+        return _size_caches[database_dir]
+
+def save_size_cache(cache, database_dir="database"):
+    """
+    Persist the compressed-size cache of a database directory.
+    
+    Args:
+        cache (dict): Cache as returned by load_size_cache
+        database_dir (str): Directory containing the database frequency files
+    """
+    with _database_lock:
+        _size_caches[database_dir] = cache
+        # Snapshot, in case another thread adds sizes while this one is pickling
+        cache = dict(cache)
+    
+    cache_file = os.path.join(database_dir, SIZE_CACHE_FILE)
+    # One temporary file per writer, so concurrent saves do not clobber each other
+    tmp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        # Write then rename, so a concurrent reader never sees a partial file
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(cache, f)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print(f"Could not save compressed size cache: {e}")
+
+def database_signature(database_dir):
+    """(path, mtime_ns, size) of every database file, sorted by path"""
+    return sorted(
+        (entry.path, entry.stat().st_mtime_ns, entry.stat().st_size)
+        for entry in os.scandir(database_dir)
+        if entry.name.endswith(".freq") and entry.is_file()
+    )
+
+def pack_database(database_dir="database"):
+    """
+    Pack the database .freq files into a single shard that load_database can map.
+    
+    Args:
+        database_dir (str): Directory containing the database frequency files
         
     Returns:
-        str: Path to the temporary concatenated file
+        int: Number of files packed
     """
-    import tempfile
+    signature = database_signature(database_dir)
+    shard_file = os.path.join(database_dir, DB_SHARD_FILE)
+    index_file = os.path.join(database_dir, DB_INDEX_FILE)
+    
+    index = []
+    offset = 0
+    with open(shard_file + ".tmp", 'wb') as f:
+        for path, mtime_ns, size in signature:
+            f.write(read_file(path))
+            index.append([path, mtime_ns, size, offset])
+            offset += size
     
-    temp_file = tempfile.mktemp()
+    with open(index_file + ".tmp", 'w') as f:
+        json.dump(index, f)
     
-    # Binary concatenation for all files
-    with open(temp_file, 'wb') as outfile:
-        for filename in [file1, file2]:
-            with open(filename, 'rb') as infile:
-                outfile.write(infile.read())
+    # Shard first: an index never points into a shard it was not written for
+    os.replace(shard_file + ".tmp", shard_file)
+    os.replace(index_file + ".tmp", index_file)
     
-    return temp_file
+    return len(index)
 
-def calculate_ncd(file1, file2, compressor="gzip"):
+def _map_database_shard(database_dir, signature):
     """
-    Calculate Normalized Compression Distance between two files.
+    Views into the mapped database shard, or None if it is missing or out of date.
+    """
+    try:
+        with open(os.path.join(database_dir, DB_INDEX_FILE)) as f:
+            index = json.load(f)
+        if [(path, mtime_ns, size) for path, mtime_ns, size, _ in index] != signature:
+            return None
+        with open(os.path.join(database_dir, DB_SHARD_FILE), 'rb') as f:
+            if not index or os.fstat(f.fileno()).st_size == 0:
+                return None
+            shard = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except (OSError, ValueError):
+        return None
+    
+    return {path: shard[offset:offset + size] for path, _, size, offset in index}
+
+def feature_format_version(data):
+    """
+    Layout version recorded in the contents of a .freq file.
     
     Args:
-        file1 (str): Path to the first file
-        file2 (str): Path to the second file
-        compressor (str): Compressor to use (gzip, bzip2, lzma, zstd)
+        data (bytes): File contents
         
     Returns:
-        float: NCD value between 0 and 1
+        int: The version (0 for internal files written before versions were
+        recorded), or None for GetMaxFreqs output, which has no versions
     """
-    # Compress individual files
-    c_x = compress_file(file1, compressor)
-    c_y = compress_file(file2, compressor)
+    if data[:4] == b"PK\x03\x04":
+        # npz archive: the version is a 0-d uint8 array, stored as the last
+        # byte of its .npy member
+        try:
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                return archive.read("format_version.npy")[-1]
+        except (KeyError, zipfile.BadZipFile):
+            return 0
+    if data[:1] == b"{":
+        match = _JSON_FORMAT_VERSION.search(data)
+        return int(match.group(1)) if match else 0
+    return None
+
+def _drop_outdated_files(contents):
+    """Remove the files written in another feature layout from loaded database contents"""
+    outdated = [
+        path for path, data in contents.items()
+        if feature_format_version(data) not in (None, FEATURE_FORMAT_VERSION)
+    ]
+    if outdated:
+        print(
+            f"Warning: skipping {len(outdated)} database files in an old format; "
+            "run process_db again to regenerate them"
+        )
+        for path in outdated:
+            del contents[path]
+    return contents
+
+def load_database(database_dir="database"):
+    """
+    Contents of the database frequency files, read once and kept in memory.
     
-    # Concatenate and compress
-    concat_file = concatenate_files(file1, file2)
-    c_xy = compress_file(concat_file, compressor)
+    If pack_database has been run, the packed shard is memory-mapped with a single
+    open instead of reading every file. Only the directory listing is checked on
+    later calls; the database is loaded again when a file is added, removed or
+    modified. Files written in another feature layout are left out.
     
-    # Clean up
-    os.unlink(concat_file)
+    Args:
+        database_dir (str): Directory containing the database frequency files
+        
+    Returns:
+        dict: Maps database file paths to their contents (bytes or memoryview)
+    """
+    try:
+        signature = database_signature(database_dir)
+    except FileNotFoundError:
+        return {}
     
+    with _database_lock:
+        cached = _databases.get(database_dir)
+        if cached is None or cached[0] != signature:
+            contents = _map_database_shard(database_dir, signature)
+            if contents is None:
+                contents = {path: read_file(path) for path, _, _ in signature}
+            contents = _drop_outdated_files(contents)
+            cached = (signature, contents)
+            _databases[database_dir] = cached
+        return cached[1]
+
+def precompute_sizes(compressor, database_dir="database"):
+    """
+    Fill the size cache with every database file's compressed size up front.
+    
+    Args:
+        compressor (str): Compressor whose sizes to compute
+        database_dir (str): Directory containing the database frequency files
+        
+    Returns:
+        int: Number of sizes that had to be computed
+    """
+    database = load_database(database_dir)
+    size_cache = load_size_cache(database_dir)
+    missing = {}
+    for db_file, data in database.items():
+        key = _size_cache_key(db_file, compressor)
+        if key not in size_cache:
+            missing[key] = compress_bytes(data, compressor)
+    
+    if missing:
+        size_cache.update(missing)
+        save_size_cache(size_cache, database_dir)
+    return len(missing)
+
+def ncd_from_sizes(c_x, c_y, c_xy):
+    """
+    Normalized Compression Distance from already computed compressed sizes.
+    
+    Args:
+        c_x (int): Compressed size of the first file
+        c_y (int): Compressed size of the second file
+        c_xy (int): Compressed size of the concatenation
+        
+    Returns:
+        float: NCD value between 0 and 1
+    """
     # If any compression failed or resulted in zero size, return maximum distance
     if c_x == 0 or c_y == 0 or c_xy == 0:
         return 1.0
     
-    # Try different NCD formulas with safe handling
-    
     # Standard NCD formula
     ncd = (c_xy - min(c_x, c_y)) / max(c_x, c_y)
-    #
-    ## Alternative formula that sometimes works better
-    #try:
-    #    ncd2 = (2 * c_xy - c_x - c_y) / (c_x + c_y)
-    #except ZeroDivisionError:
-    #    ncd2 = 1.0
-    #
-    ## Another alternative that emphasizes the difference
-    #try:
-    #    denominator = c_x + c_y - c_xy
-    #    # Check for zero or negative denominator
-    #    if denominator <= 0:
-    #        ncd3 = 1.0
-    #    else:
-    #        ncd3 = c_xy / denominator
-    #except ZeroDivisionError:
-    #    ncd3 = 1.0
-    #
-    ## Use the formula that gives the most discriminative result
-    # For music identification, we want the formula that gives the smallest value for similar files
-    #if file1.split('/')[-1].split('_')[0] == file2.split('/')[-1].split('.')[0]:
-    #    # If we're comparing a segment with its source (based on filename pattern), 
-    #    # use the formula that gives the smallest value
-    #    ncd = min(ncd1, ncd2, ncd3)
-    #else:
-    #    # Otherwise use the standard formula
-    #    ncd = ncd1
     
     # Ensure NCD is in valid range [0, 1]
-    ncd = max(0.0, min(1.0, ncd))
+    return max(0.0, min(1.0, ncd))
+
+def ncd_bytes(data_x, data_y, compressor="gzip", c_x=None, c_y=None, prefix_key=None):
+    """
+    Calculate Normalized Compression Distance between two in-memory buffers.
     
-    # Apply scaling to better differentiate values
-    if ncd > 0.9:
-        # Scale the range [0.9, 1.0] to [0.7, 1.0]
-        ncd = 0.7 + (ncd - 0.9) * 3
+    With "zstd_prefix", C(xy) is taken as C(y) plus the size of x compressed with
+    y preloaded as a raw-content prefix, so only x goes through the compressor.
+    
+    Args:
+        data_x (bytes): First buffer
+        data_y (bytes): Second buffer
+        compressor (str): Compressor to use (gzip, bzip2, lzma, zstd, zstd_fast, zstd_dict, lz4, zstd_prefix)
+        c_x (int, optional): Precomputed compressed size of data_x
+        c_y (int, optional): Precomputed compressed size of data_y
+        prefix_key (tuple, optional): Cache key for data_y's zstd prefix
+        
+    Returns:
+        float: NCD value between 0 and 1
+    """
+    if c_x is None:
+        c_x = compress_bytes(data_x, compressor)
+    if c_y is None:
+        c_y = compress_bytes(data_y, compressor)
+    
+    if compressor == "zstd_prefix":
+        prefix = _zstd_prefix(data_y, prefix_key)
+        c_xy = c_y + len(_zstd_compressor(3, prefix).compress(data_x))
+    else:
+        # Stream both buffers through one compressor instead of concatenating them
+        c_xy = compress_parts([data_x, data_y], compressor)
+    
+    return ncd_from_sizes(c_x, c_y, c_xy)
+
+def calculate_ncd(file1, file2, compressor="gzip", c_x=None, c_y=None):
+    """
+    Calculate Normalized Compression Distance between two files.
     
-    return ncd
+    Args:
+        file1 (str): Path to the first file
+        file2 (str): Path to the second file
+        compressor (str): Compressor to use (gzip, bzip2, lzma, zstd, zstd_fast, zstd_dict, lz4, zstd_prefix)
+        c_x (int, optional): Precomputed compressed size of file1
+        c_y (int, optional): Precomputed compressed size of file2
+        
+    Returns:
+        float: NCD value between 0 and 1
+    """
+    with mapped_file(file1) as data_x, mapped_file(file2) as data_y:
+        return ncd_bytes(data_x, data_y, compressor, c_x=c_x, c_y=c_y)
+
+def _inherited_database_file(db_file):
+    """
+    Contents of a database file from the copy loaded before the pool forked, or None
+    """
+    cached = _databases.get(os.path.dirname(db_file))
+    if cached is not None:
+        return cached[1].get(db_file)
+    return None
 
-def calculate_ncd_with_database(query_file, compressor="gzip"):
+def _ncd_with_database_file(query_data, c_x, c_y, db_file, compressor, db_data=None):
+    """
+    NCD between the query and one database file (runs inside a worker process).
+    
+    Returns the database file's compressed size too, so the caller can cache it.
+    """
+    name = os.path.splitext(os.path.basename(db_file))[0]
+    if db_data is None:
+        # Forked workers inherit the database the parent loaded before the scan
+        db_data = _inherited_database_file(db_file)
+    if db_data is None:
+        with mapped_file(db_file) as db_data:
+            return _ncd_with_database_file(query_data, c_x, c_y, db_file, compressor, db_data)
+    
+    if c_y is None:
+        c_y = compress_bytes(db_data, compressor)
+    prefix_key = _size_cache_key(db_file, compressor) if compressor == "zstd_prefix" else None
+    ncd = ncd_bytes(query_data, db_data, compressor, c_x=c_x, c_y=c_y, prefix_key=prefix_key)
+    return name, ncd, c_y
+
+def _scan_database(
+    query_data,
+    database_files,
+    compressor,
+    max_workers=None,
+    database=None,
+    prune_top=None
+):
+    """
+    NCD between the query and each of the given database files.
+    
+    With prune_top, files are visited in order of the lower bound
+    |c_x - c_y| / max(c_x, c_y) <= NCD (since c_xy >= max(c_x, c_y)), and the
+    concatenation is not compressed for files whose bound already rules them out
+    of the best prune_top; those are reported with distance None. Compressors in
+    UNPRUNABLE_COMPRESSORS are never pruned.
+    
+    Args:
+        query_data (bytes): Contents of the query frequency file
+        database_files (list): Paths of the database files to compare against
+        compressor (str): Compressor to use
+        max_workers (int, optional): Number of worker processes (default: CPU count)
+        database (dict, optional): In-memory file contents, as returned by load_database
+        prune_top (int, optional): Only the best prune_top distances need to be exact
+        
+    Returns:
+        list: (name, ncd) tuples in the order of database_files (ncd is None
+            for pruned files)
+    """
+    # The query is compressed once; database sizes come from the persistent cache
+    c_x = compress_bytes(query_data, compressor)
+    database_dir = os.path.dirname(database_files[0]) if database_files else "database"
+    size_cache = load_size_cache(database_dir)
+    keys = [_size_cache_key(db_file, compressor) for db_file in database_files]
+    sizes = [size_cache.get(key) for key in keys]
+    jobs = [None] * len(database_files)
+    
+    max_workers = max_workers or os.cpu_count()
+    executor = None
+    if max_workers > 1 and len(database_files) > 1:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    
+    def run(indices):
+        """Score the given database files, spread across processes"""
+        args = (
+            [query_data] * len(indices),
+            [c_x] * len(indices),
+            [sizes[i] for i in indices],
+            [database_files[i] for i in indices],
+            [compressor] * len(indices)
+        )
+        if executor is None:
+            # In-process scans are handed the in-memory copy; forked workers inherit it
+            contents = [database.get(database_files[i]) if database else None for i in indices]
+            batch = map(_ncd_with_database_file, *args, contents)
+        else:
+            # Hand each worker a few batches instead of one round trip per file
+            chunksize = max(1, len(indices) // (max_workers * 4))
+            batch = executor.map(_ncd_with_database_file, *args, chunksize=chunksize)
+        for i, job in zip(indices, batch):
+            jobs[i] = job
+            sizes[i] = job[2]
+    
+    try:
+        if (
+            prune_top is None
+            or prune_top >= len(database_files)
+            or compressor in UNPRUNABLE_COMPRESSORS
+        ):
+            run(range(len(database_files)))
+        else:
+            # The bound needs every c_y, which is cheap next to compressing x||y
+            missing = [i for i, c_y in enumerate(sizes) if c_y is None]
+            paths = [database_files[i] for i in missing]
+            if executor is None:
+                computed = [compress_file(path, compressor) for path in paths]
+            else:
+                computed = executor.map(compress_file, paths, [compressor] * len(paths))
+            for i, c_y in zip(missing, computed):
+                sizes[i] = c_y
+            
+            bounds = [
+                abs(c_x - c_y) / max(c_x, c_y) if c_x and c_y else 1.0
+                for c_y in sizes
+            ]
+            order = sorted(range(len(database_files)), key=bounds.__getitem__)
+            
+            # Max-heap (negated) of the best prune_top distances found so far
+            best = []
+            step = 1 if executor is None else max(prune_top, max_workers)
+            for pos in range(0, len(order), step):
+                threshold = -best[0] if len(best) == prune_top else float("inf")
+                batch = [i for i in order[pos:pos + step] if bounds[i] < threshold]
+                if not batch:
+                    # Bounds only grow from here on
+                    break
+                run(batch)
+                for i in batch:
+                    if len(best) < prune_top:
+                        heapq.heappush(best, -jobs[i][1])
+                    else:
+                        heapq.heappushpop(best, -jobs[i][1])
+            
+            for i, db_file in enumerate(database_files):
+                if jobs[i] is None:
+                    name = os.path.splitext(os.path.basename(db_file))[0]
+                    jobs[i] = (name, None, sizes[i])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    
+    # Remember sizes computed along the way for the next query
+    missing = {key: c_y for key, c_y in zip(keys, sizes) if key not in size_cache}
+    if missing:
+        size_cache.update(missing)
+        save_size_cache(size_cache, database_dir)
+    
+    return [(name, ncd) for name, ncd, _ in jobs]
+
+def calculate_ncd_with_database(
+    query_file,
+    compressor="gzip",
+    max_workers=None,
+    rescore_compressor=None,
+    rescore_top=10,
+    prune_top=None,
+    verbose=True
+):
     """
     Calculate NCD between a query file and all files in the database.
     
+    With a rescore compressor the scan is two-stage: the whole database is ranked
+    with the (fast) compressor, then only the best rescore_top candidates are
+    scored again with the (stronger) rescore compressor, and only those are
+    returned so every returned distance comes from the same compressor.
+    
     Args:
         query_file (str): Path to the query frequency file
         compressor (str): Compressor to use
+        max_workers (int, optional): Number of worker processes (default: CPU count)
+        rescore_compressor (str, optional): Compressor used to re-score the top candidates
+        rescore_top (int): Number of candidates to re-score
+        prune_top (int, optional): Skip exact scoring of files that cannot reach this
+            many best matches; they are left out of the results
+        verbose (bool): Print progress and every distance
         
     Returns:
         dict: Dictionary mapping database file names to NCD values
@@ -145,22 +753,128 @@ def calculate_ncd_with_database(query_file, compressor="gzip"):
     results = {}
     database_dir = "database"
     
-    # Find all frequency files in the database directory
-    database_files = glob.glob(os.path.join(database_dir, "*.freq"))
+    # The database is read once per process and reused by later queries
+    database = load_database(database_dir)
+    database_files = list(database)
     
     if not database_files:
         print(f"No frequency files found in {database_dir}")
         return {}
     
-    print(f"Comparing {query_file} with {len(database_files)} database files using {compressor}...")
+    if verbose:
+        print(f"Comparing {query_file} with {len(database_files)} database files using {compressor}...")
+    
+    # The query is read once and shared by every comparison
+    query_data = read_file(query_file)
+    
+    if rescore_compressor is not None and prune_top is not None:
+        # The first stage must keep every candidate that will be re-scored exact
+        prune_top = max(prune_top, rescore_top)
+    jobs = _scan_database(
+        query_data, database_files, compressor, max_workers, database, prune_top
+    )
     
-    # Calculate NCD for each database file
-    for db_file in database_files:
-        name = os.path.splitext(os.path.basename(db_file))[0]
-        ncd = calculate_ncd(query_file, db_file, compressor)
+    if rescore_compressor is not None:
+        scored = [(job, db_file) for job, db_file in zip(jobs, database_files) if job[1] is not None]
+        ranked = heapq.nsmallest(rescore_top, scored, key=lambda job: job[0][1])
+        candidates = [db_file for _, db_file in ranked]
+        if verbose:
+            print(f"Re-scoring the top {len(candidates)} candidates using {rescore_compressor}...")
+        jobs = _scan_database(query_data, candidates, rescore_compressor, max_workers, database)
+    
+    for name, ncd in jobs:
+        if ncd is None:
+            # Pruned: never scored, so no distance is reported
+            continue
         results[name] = ncd
-        print(f"  {name}: {ncd:.4f}")
+        if verbose:
+            print(f"  {name}: {ncd:.4f}")
+    
+    return results
+
+def _ncd_batch_database_file(queries, c_xs, c_y, db_file, compressor, db_data=None):
+    """
+    NCD between every query and one database file (runs inside a worker process).
+    
+    Returns the database file's compressed size too, so the caller can cache it.
+    """
+    name = os.path.splitext(os.path.basename(db_file))[0]
+    if db_data is None:
+        # Forked workers inherit the database the parent loaded before the scan
+        db_data = _inherited_database_file(db_file)
+    if db_data is None:
+        with mapped_file(db_file) as db_data:
+            return _ncd_batch_database_file(queries, c_xs, c_y, db_file, compressor, db_data)
+    
+    if c_y is None:
+        c_y = compress_bytes(db_data, compressor)
+    prefix_key = _size_cache_key(db_file, compressor) if compressor == "zstd_prefix" else None
+    ncds = [
+        ncd_bytes(query_data, db_data, compressor, c_x=c_x, c_y=c_y, prefix_key=prefix_key)
+        for query_data, c_x in zip(queries, c_xs)
+    ]
+    return name, ncds, c_y
+
+def calculate_ncd_batch(query_files, compressor="gzip", max_workers=None):
+    """
+    Calculate NCD between several query files and all files in the database.
+    
+    The loop runs over database files on the outside, so each one is read,
+    sized (and, for zstd_prefix, loaded as a prefix) once for all the queries,
+    e.g. the overlapping segments of one recording.
+    
+    Args:
+        query_files (list): Paths of the query frequency files
+        compressor (str): Compressor to use
+        max_workers (int, optional): Number of worker processes (default: CPU count)
+        
+    Returns:
+        list: One dictionary per query, mapping database file names to NCD values
+    """
+    if not query_files:
+        return []
+    
+    database_dir = "database"
+    database = load_database(database_dir)
+    database_files = list(database)
+    
+    if not database_files:
+        print(f"No frequency files found in {database_dir}")
+        return [{} for _ in query_files]
+    
+    print(f"Comparing {len(query_files)} queries with {len(database_files)} database files using {compressor}...")
     
+    queries = [read_file(query_file) for query_file in query_files]
+    c_xs = [compress_bytes(query_data, compressor) for query_data in queries]
+    size_cache = load_size_cache(database_dir)
+    keys = [_size_cache_key(db_file, compressor) for db_file in database_files]
+    
+    args = (
+        [queries] * len(database_files),
+        [c_xs] * len(database_files),
+        [size_cache.get(key) for key in keys],
+        database_files,
+        [compressor] * len(database_files)
+    )
+    
+    max_workers = max_workers or os.cpu_count()
+    if max_workers == 1 or len(database_files) == 1:
+        jobs = list(map(_ncd_batch_database_file, *args, database.values()))
+    else:
+        chunksize = max(1, len(database_files) // (max_workers * 4))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            jobs = list(executor.map(_ncd_batch_database_file, *args, chunksize=chunksize))
+    
+    # Remember sizes computed by the workers for the next query
+    missing = {key: c_y for key, (_, _, c_y) in zip(keys, jobs) if key not in size_cache}
+    if missing:
+        size_cache.update(missing)
+        save_size_cache(size_cache, database_dir)
+    
+    results = [{} for _ in query_files]
+    for name, ncds, _ in jobs:
+        for query_results, ncd in zip(results, ncds):
+            query_results[name] = ncd
     return results
 
 def compare_compressors(file1, file2, compressors=None):
@@ -176,15 +890,25 @@ def compare_compressors(file1, file2, compressors=None):
         dict: Dictionary mapping compressor names to NCD values
     """
     if compressors is None:
-        compressors = ["gzip", "bzip2", "lzma", "zstd"]
+        # bzip2/lzma are much slower for similar discrimination; request them explicitly
+        compressors = ["gzip", "zstd"]
     
     results = {}
     
-    for compressor in compressors:
-        try:
-            ncd = calculate_ncd(file1, file2, compressor)
-            results[compressor] = ncd
-        except Exception as e:
-            print(f"Error with compressor {compressor}: {e}")
+    # Both files are read once and shared by every compressor
+    data_x = read_file(file1)
+    data_y = read_file(file2)
+    
+    # zlib/bz2/lzma release the GIL while compressing, so run them side by side
+    with ThreadPoolExecutor(max_workers=max(1, len(compressors))) as executor:
+        futures = {
+            compressor: executor.submit(ncd_bytes, data_x, data_y, compressor)
+            for compressor in compressors
+        }
+        for compressor, future in futures.items():
+            try:
+                results[compressor] = future.result()
+            except Exception as e:
+                print(f"Error with compressor {compressor}: {e}")
     
     return results 
\ No newline at end of file
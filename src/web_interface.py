@@ -1,23 +1,50 @@
 #!/usr/bin/env python3
 from flask import Flask, render_template, request, jsonify
+import atexit
+import io
 import os
+import shutil
 import tempfile
+import wave
 import sounddevice as sd
 import soundfile as sf
 import numpy as np
-from audio_processing import convert_to_mono_wav
-from feature_extraction import convert_to_frequencies
-from ncd import calculate_ncd_with_database
+from audio_processing import export_wav
+from feature_extraction import convert_to_frequencies, limit_worker_threads
+from ncd import (
+    DEFAULT_COMPRESSOR,
+    calculate_ncd_batch,
+    load_database,
+    precompute_sizes,
+)
 from music_identification import identify_music
 import base64
 from pydub import AudioSegment
 import collections
 from statistics import mode, multimode
 import socket
-import math
+import hashlib
+import importlib.util
+import heapq
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    import av
+except ImportError:
+    av = None
 
 app = Flask(__name__)
 
+# Scratch files of every request live here and are reused, not recreated
+TEMP_DIR = tempfile.mkdtemp(prefix="music_id_")
+atexit.register(shutil.rmtree, TEMP_DIR, ignore_errors=True)
+
+# Matches of recently seen segments, keyed by a hash of their audio (LRU order)
+SEGMENT_CACHE_SIZE = 64
+_segment_cache = collections.OrderedDict()
+_segment_cache_lock = threading.Lock()
+
 # Ensure the templates directory exists
 os.makedirs("templates", exist_ok=True)
 
@@ -40,131 +67,263 @@ def index():
     return render_template("index.html")
 
 
-def process_segment(audio_segment, temp_dir):
-    """Process a single audio segment and return its identification results"""
-    # Save segment to temporary file
-    temp_wav = tempfile.NamedTemporaryFile(suffix=".wav", dir=temp_dir, delete=False)
-    audio_segment.export(temp_wav.name, format="wav")
-
-    try:
-        # Convert to mono WAV
-        mono_wav = convert_to_mono_wav(temp_wav.name)
-
-        # Convert to frequency representation
-        temp_freq = tempfile.NamedTemporaryFile(
-            suffix=".freq", dir=temp_dir, delete=False
-        )
-        freq_file = convert_to_frequencies(mono_wav, temp_freq.name)
-
-        if freq_file is None:
-            return None
-
-        # Calculate NCD with database
-        ncd_results = calculate_ncd_with_database(freq_file, compressor="bzip2")
+def decode_upload(audio_bytes):
+    """
+    Decode an uploaded recording in memory, as 44.1 kHz 16-bit stereo
 
-        # Identify the music
-        matches = identify_music(ncd_results, num_results=3)
+    PCM WAV is parsed with the wave module (segments are converted to
+    44.1 kHz stereo later). Otherwise PyAV decodes in-process; without it
+    pydub hands the bytes to ffmpeg.
 
-        return matches
+    Args:
+        audio_bytes (bytes): Encoded audio (e.g. WebM/Opus from the browser)
 
-    finally:
-        # Clean up temporary files
-        os.unlink(temp_wav.name)
-        if mono_wav and mono_wav != temp_wav.name:
-            os.unlink(mono_wav)
-        if freq_file:
-            os.unlink(freq_file)
+    Returns:
+        AudioSegment: The decoded audio
+    """
+    if audio_bytes[:4] == b"RIFF":
+        try:
+            with wave.open(io.BytesIO(audio_bytes)) as w:
+                return AudioSegment(
+                    data=w.readframes(w.getnframes()),
+                    sample_width=w.getsampwidth(),
+                    frame_rate=w.getframerate(),
+                    channels=w.getnchannels(),
+                )
+        except (wave.Error, EOFError):
+            # Not plain PCM (e.g. float or compressed WAV), use a full decoder
+            pass
+
+    if av is None:
+        return AudioSegment.from_file(io.BytesIO(audio_bytes))
+
+    resampler = av.AudioResampler(format="s16", layout="stereo", rate=44100)
+    chunks = []
+    with av.open(io.BytesIO(audio_bytes)) as container:
+        for frame in container.decode(audio=0):
+            for resampled in resampler.resample(frame):
+                chunks.append(resampled.to_ndarray().tobytes())
+    # Drain the samples the resampler still buffers
+    for resampled in resampler.resample(None):
+        chunks.append(resampled.to_ndarray().tobytes())
+
+    return AudioSegment(
+        data=b"".join(chunks), sample_width=2, frame_rate=44100, channels=2
+    )
+
+
+def _prepare_segment(audio_segment):
+    """Downmix to mono, then lay out as the 44.1 kHz 16-bit stereo GetMaxFreqs reads"""
+    # Done in memory, so the only file written is the one handed to the extractor.
+    # Both channels carry the mono mix, as for the database entries
+    return (
+        audio_segment.set_frame_rate(44100)
+        .set_channels(1)
+        .set_channels(2)
+        .set_sample_width(2)
+    )
+
+
+def _segment_key(audio_segment):
+    """Identical audio (silence, loops, repeated uploads) gives identical matches"""
+    return hashlib.blake2b(audio_segment.raw_data, digest_size=16).digest()
+
+
+def _cached_matches(key, database):
+    """Matches remembered for this audio, or None"""
+    with _segment_cache_lock:
+        cached = _segment_cache.get(key)
+        if cached is not None and cached[0] is database:
+            _segment_cache.move_to_end(key)
+            return cached[1]
+    return None
+
+
+def _remember_matches(key, database, matches):
+    """Store a segment's matches, evicting the least recently used ones"""
+    with _segment_cache_lock:
+        _segment_cache[key] = (database, matches)
+        if len(_segment_cache) > SEGMENT_CACHE_SIZE:
+            _segment_cache.popitem(last=False)
+
+
+def _segment_paths(slot):
+    """
+    Reusable WAV and .freq paths for one segment slot of the calling thread
+
+    Each thread handles one request at a time, so the files are simply
+    overwritten by its next request instead of being created and deleted.
+    """
+    base = os.path.join(
+        TEMP_DIR, f"segment_{os.getpid()}_{threading.get_ident()}_{slot}"
+    )
+    return base + ".wav", base + ".freq"
+
+
+def _extract_raw_segment(raw_data, frame_rate, channels, wav_path, freq_path):
+    """Extract features of a prepared segment sent as raw PCM (runs in a worker)"""
+    audio_segment = AudioSegment(
+        data=raw_data, sample_width=2, frame_rate=frame_rate, channels=channels
+    )
+    return _extract_segment(audio_segment, wav_path, freq_path)
+
+
+def _extract_segment(audio_segment, wav_path, freq_path):
+    """
+    Write a prepared segment's frequency file
+
+    Returns:
+        str: Path to the frequency file or None if failed
+    """
+    export_wav(audio_segment, wav_path)
+    return convert_to_frequencies(wav_path, freq_path)
 
 
 @app.route("/record", methods=["POST"])
 def record_audio():
     try:
-        audio_b64 = request.get_json()["audio"]
-
-        # Decode base64 to bytes
-        audio_bytes = base64.b64decode(audio_b64)
-
-        # Save to temporary WAV file
-        temp_wav = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-        with open(temp_wav.name, "wb") as f:
-            f.write(audio_bytes)
-
-        try:
-            # Load the audio file
-            audio = AudioSegment.from_file(temp_wav.name)
-
-            # Create a temporary directory for segment processing
-            temp_dir = tempfile.mkdtemp()
-
-            # Process multiple overlapping segments
-            segment_duration = 7000  # 7 seconds
-            overlap = 1000  # 1 second overlap
-            all_matches = []
-
+        if request.is_json:
+            # Older clients post the recording base64-encoded inside JSON
+            audio_bytes = base64.b64decode(request.get_json()["audio"])
+        else:
+            # The page posts the recorded blob itself as the request body
+            audio_bytes = request.get_data(cache=False)
+
+        # Decode straight from memory instead of a temporary upload file
+        audio = decode_upload(audio_bytes)
+
+        # Process multiple overlapping segments
+        segment_duration = 7000  # 7 seconds
+        overlap = 1000  # 1 second overlap
+        segments = [
+            _prepare_segment(audio[start_ms : start_ms + segment_duration])
             for start_ms in range(
                 0, len(audio) - segment_duration, segment_duration - overlap
-            ):
-                segment = audio[start_ms : start_ms + segment_duration]
-                matches = process_segment(segment, temp_dir)
-                if matches:
-                    all_matches.extend(matches)
-
-            if not all_matches:
-                return jsonify({"success": True, "matches": []})
-
-            # Get all song names from matches
-            song_names = [name for name, _ in all_matches]
-
-            # Count occurrences of each song
-            song_counts = collections.Counter(song_names)
-
-            # Get the most common songs (up to 3)
-            most_common = song_counts.most_common(3)
-
-            # For each most common song, calculate its average distance
-            final_matches = []
-            for name, count in most_common:
-                # Get all distances for this song
-                distances = [
-                    float(distance)
-                    for song_name, distance in all_matches
-                    if song_name == name
-                ]
-                # Calculate average distance
-                avg_distance = sum(distances) / len(distances)
-                final_matches.append((name, avg_distance))
-
-            no_matches = all(
-                math.isclose(match[1], 1.0, rel_tol=1e-9) for match in final_matches
             )
+        ]
+
+        # Only segments whose audio has not been seen before need identifying
+        database = load_database()
+        keys = [_segment_key(segment) for segment in segments]
+        segment_matches = [_cached_matches(key, database) for key in keys]
+        pending = [i for i, matches in enumerate(segment_matches) if matches is None]
+
+        # Segments are independent, so extract them in parallel processes
+        freq_files = {}
+        if pending:
+            with ProcessPoolExecutor(
+                max_workers=min(len(pending), os.cpu_count() or 1),
+                initializer=limit_worker_threads,
+            ) as executor:
+                futures = {
+                    executor.submit(
+                        _extract_raw_segment,
+                        segments[i].raw_data,
+                        segments[i].frame_rate,
+                        segments[i].channels,
+                        *_segment_paths(i),
+                    ): i
+                    for i in pending
+                }
+                for future in as_completed(futures):
+                    if future.result() is not None:
+                        freq_files[futures[future]] = future.result()
+
+        # One pass over the database scores every segment of the recording
+        batch = sorted(freq_files)
+        batch_results = calculate_ncd_batch(
+            [freq_files[i] for i in batch], compressor=DEFAULT_COMPRESSOR
+        )
+        for i, ncd_results in zip(batch, batch_results):
+            segment_matches[i] = identify_music(ncd_results, num_results=3)
+            _remember_matches(keys[i], database, segment_matches[i])
+
+        # Keep segment order, so ties in the vote below resolve as before
+        all_matches = [
+            match for matches in segment_matches if matches for match in matches
+        ]
+
+        if not all_matches:
+            return jsonify({"success": True, "matches": []})
+
+        # Count occurrences and sum distances of each song in one pass
+        song_stats = collections.defaultdict(lambda: [0, 0.0])
+        for name, distance in all_matches:
+            stats = song_stats[name]
+            stats[0] += 1
+            stats[1] += float(distance)
+
+        # Get the most common songs (up to 3) with their average distance;
+        # ties keep first-seen order, as Counter.most_common did
+        most_common = heapq.nlargest(3, song_stats.items(), key=lambda item: item[1][0])
+        final_matches = [(name, total / count) for name, (count, total) in most_common]
+
+        # NCD never exceeds 1.0, so "every average is 1.0" is a check on the minimum
+        if min(distance for _, distance in final_matches) >= 1.0 - 1e-9:
+            return jsonify({"success": True, "matches": []})
+
+        # Format results
+        results = [
+            {"name": name, "distance": f"{distance:.4f}"}
+            for name, distance in final_matches
+        ]
+
+        return jsonify({"success": True, "matches": results})
 
-            if no_matches:
-                return jsonify({"success": True, "matches": []})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-            # Format results
-            results = [
-                {"name": name, "distance": f"{distance:.4f}"}
-                for name, distance in final_matches
-            ]
 
-            return jsonify({"success": True, "matches": results})
+def run_gunicorn(certfile, keyfile, port=5001):
+    """
+    Serve the app with a pool of gunicorn worker processes (threads inside each)
 
-        finally:
-            # Clean up temporary files
-            os.unlink(temp_wav.name)
-            # Clean up temporary directory
-            for file in os.listdir(temp_dir):
-                os.unlink(os.path.join(temp_dir, file))
-            os.rmdir(temp_dir)
+    The app is loaded before forking, so every worker inherits the warmed-up
+    database instead of loading its own.
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    Args:
+        certfile (str): TLS certificate (browsers only allow the microphone over HTTPS)
+        keyfile (str): TLS private key
+        port (int): Port to listen on
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class StandaloneApplication(BaseApplication):
+        def load_config(self):
+            for key, value in {
+                "bind": f"0.0.0.0:{port}",
+                "workers": os.cpu_count() or 1,
+                "worker_class": "gthread",
+                "threads": 4,
+                "preload_app": True,
+                "certfile": certfile,
+                "keyfile": keyfile,
+            }.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    StandaloneApplication().run()
 
 
 if __name__ == "__main__":
+    # Read the database and compress each file once up front; every request
+    # reuses the in-memory copy and the cached sizes
+    load_database()
+    precompute_sizes(DEFAULT_COMPRESSOR)
+
     local_ip = get_local_ip()
     print(f"\nServidor rodando em:")
     print(f"Local:   https://localhost:5001")
     print(f"Rede:    https://{local_ip}:5001")
     print("\nAcesse qualquer um dos endereços acima para usar a aplicação.")
-    app.run(host="0.0.0.0", port=5001, debug=True, ssl_context="adhoc")
+
+    # With a certificate and gunicorn installed, serve recordings from several
+    # processes; otherwise fall back to Flask's development server
+    certfile = os.environ.get("SSL_CERTFILE")
+    keyfile = os.environ.get("SSL_KEYFILE")
+    if certfile and keyfile and importlib.util.find_spec("gunicorn") is not None:
+        run_gunicorn(certfile, keyfile)
+    else:
+        app.run(host="0.0.0.0", port=5001, debug=True, ssl_context="adhoc")